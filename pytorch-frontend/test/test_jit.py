@@ -5687,6 +5687,106 @@ a")
         ast = torch.jit.frontend.get_jit_def(fn, fn.__name__)
         self.assertExpected(str(ast))
 
+    def test_python_frontend_def_cache(self):
+        def fn(x):
+            return x + 1
+
+        ast = torch.jit.frontend.get_jit_def(fn, fn.__name__)
+        self.assertIs(ast, torch.jit.frontend.get_jit_def(fn, fn.__name__))
+        self.assertIsNot(ast, torch.jit.frontend.get_jit_def(fn, "other"))
+
+    def test_python_frontend_cache_wrapped(self):
+        def deco(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                return fn(*args, **kwargs)
+            return wrapper
+
+        @deco
+        def fn_a(x):
+            return x.sigmoid()
+
+        @deco
+        def fn_b(x):
+            return x.relu()
+
+        # Both wrappers share a code object and the same def name
+        ast_a = torch.jit.frontend.get_jit_def(fn_a, "forward")
+        ast_b = torch.jit.frontend.get_jit_def(fn_b, "forward")
+        FileCheck().check("sigmoid").check_not("relu").run(str(ast_a))
+        FileCheck().check("relu").check_not("sigmoid").run(str(ast_b))
+
+        get_source_lines_and_file = torch.jit.frontend._get_source_lines_and_file
+        self.assertIn("sigmoid", "".join(get_source_lines_and_file(fn_a)[0]))
+        self.assertIn("relu", "".join(get_source_lines_and_file(fn_b)[0]))
+
+    def test_python_frontend_class_def(self):
+        def outside(self, x):
+            return x.relu()
+
+        def helper(self, x):
+            return x
+
+        class Foo(object):
+            def __init__(self):
+                self.a = 1
+
+            @torch.jit.export
+            def typed(self, x):
+                # type: (int) -> int
+                return x + 1
+
+            @torch.jit.unused
+            def skipped(self, x):
+                return x.sigmoid()
+
+            @property
+            def prop(self):
+                return self.a
+
+            @prop.setter
+            def prop(self, value):
+                self.a = value
+
+            # Bound under a name other than their own, so not compiled
+            lam = lambda self: 1  # noqa: E731
+            unbound = helper
+
+        # Not part of the class body, so built on its own
+        Foo.outside = outside
+
+        ast = torch.jit.frontend.get_jit_class_def(Foo, "Foo")
+        self.assertNotIn("(ident lam)", str(ast))
+        self.assertNotIn("(ident unbound)", str(ast))
+        FileCheck().check("(ident outside)").check("relu") \
+                   .check("(ident skipped)").check("(variable (ident Any))").check("Cannot call @unused methods") \
+                   .check_not("sigmoid") \
+                   .check("(ident typed)").check("(variable (ident int))").check("(variable (ident int))") \
+                   .check("(ident prop)").check("(ident value)") \
+                   .run(str(ast))
+
+    def test_python_frontend_docstring(self):
+        def fn(x):
+            """this docstring is not compiled"""
+            return x
+
+        ast = torch.jit.frontend.get_jit_def(fn, fn.__name__)
+        self.assertNotIn("docstring", str(ast))
+
+    def test_python_frontend_default_args(self):
+        def fn(a, b=1, *, c, d=2.5):
+            return a
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return fn(*args, **kwargs)
+
+        get_default_args = torch.jit.frontend.get_default_args
+        self.assertEqual(get_default_args(fn), {'b': 1, 'd': 2.5})
+        self.assertEqual(get_default_args(wrapper), {'b': 1, 'd': 2.5})
+        self.assertEqual(get_default_args(lambda x: x), {})
+        self.assertEqual(get_default_args(None), {})
+
     def _make_scalar_vars(self, arr, dtype):
         return [torch.tensor(val, dtype=dtype) for val in arr]
 
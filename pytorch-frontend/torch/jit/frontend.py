@@ -3,7 +3,8 @@ import sys
 import ast
 import inspect
 import string
-from textwrap import dedent
+import linecache
+import functools
 from torch._C._jit_tree_views import (
     ClassDef, Ident, Stmt, Decl, Def, Var,
     EmptyTypeAnnotation, Param, ExprStmt, Assign,
@@ -23,8 +24,24 @@ import torch.jit.annotations
 # https://github.com/python/cpython/blob/561612d8456cfab5672c9b445521113b847bd6b3/Lib/textwrap.py#L411#
 
 _reserved_prefix = '__jit'
-_reserved_names = {'print'}
-_identifier_chars = set(string.ascii_lowercase + string.ascii_uppercase + string.digits)
+_reserved_names = frozenset({'print'})
+_identifier_chars = frozenset(string.ascii_lowercase + string.ascii_uppercase + string.digits)
+_whitespace_bytes = frozenset(string.whitespace.encode('utf-8'))
+
+
+def _get_source_bytes(ctx):
+    # Source ranges are offsets into the UTF-8 encoded source, and `ctx.source`
+    # copies the whole source out of C++ on every access, so encode it once per
+    # context
+    source = getattr(ctx, '_source_bytes', None)
+    if source is None:
+        source = ctx._source_bytes = ctx.source.encode('utf-8')
+    return source
+
+
+def _keyword_range(ctx, node, keyword_len):
+    # Range of the keyword a statement starts with, e.g. `return` in `return x`
+    return ctx.make_range(node.lineno, node.col_offset, node.col_offset + keyword_len)
 
 
 def is_reserved_name(name):
@@ -84,6 +101,32 @@ if sys.version_info >= (3, 6):
     # NB: no specific token for AnnAssign
 
 
+# String literals parse to ast.Str before Python 3.8 and to ast.Constant after
+# (where ast.Str is only a deprecated alias)
+_ast_Str = ast.Str if sys.version_info < (3, 8) else None
+
+# Subscripts wrap plain indices in ast.Index and multi-dimensional slices in
+# ast.ExtSlice before Python 3.9, and `...` parses to ast.Ellipsis before 3.8
+_ast_Index = ast.Index if sys.version_info < (3, 9) else None
+_ast_ExtSlice = ast.ExtSlice if sys.version_info < (3, 9) else None
+_ast_Ellipsis = ast.Ellipsis if sys.version_info < (3, 8) else None
+
+# From Python 3.8 on these node types are only deprecated aliases of
+# ast.Constant, which the parser never produces and which warn when read
+_ast_constant_aliases = frozenset({'Num', 'Str', 'Bytes', 'NameConstant', 'Ellipsis'}) \
+    if sys.version_info >= (3, 8) else frozenset()
+
+# Names that build_Name turns into literals rather than variable references
+_name_literals = {
+    "True": TrueLiteral,
+    "False": FalseLiteral,
+    "None": NoneLiteral,
+}
+
+
+_node_start_token_lens = {node_type: len(token) for node_type, token in node_start_tokens.items()}
+
+
 class FrontendError(Exception):
     def __init__(self, source_range, msg):
         self.source_range = source_range
@@ -105,10 +148,8 @@ class UnsupportedNodeError(NotSupportedError):
     def __init__(self, ctx, offending_node, reason=''):
         # If we don't have a specific token, we default to length of 1
         node_type = type(offending_node)
-        range_len = len(node_start_tokens.get(node_type, ' '))
-        source_range = ctx.make_range(offending_node.lineno,
-                                      offending_node.col_offset,
-                                      offending_node.col_offset + range_len)
+        range_len = _node_start_token_lens.get(node_type, 1)
+        source_range = _keyword_range(ctx, offending_node, range_len)
         feature_name = pretty_node_names.get(node_type, node_type.__name__)
         msg = "{} {}aren't supported".format(feature_name, reason + ' ' if reason else '')
         super(UnsupportedNodeError, self).__init__(source_range, msg)
@@ -119,61 +160,226 @@ class FrontendTypeError(FrontendError):
 
 
 def build_withitems(ctx, items):
-    items = [build_withitem(ctx, i) for i in items]
-    return list(items)
+    return [build_withitem(ctx, i) for i in items]
 
 
 def build_stmts(ctx, stmts):
-    stmts = [build_stmt(ctx, s) for s in stmts]
-    return list(filter(None, stmts))
+    # Statements that don't produce anything (e.g. docstrings) come back as None
+    build = build_stmt
+    result = []
+    append = result.append
+    for s in stmts:
+        stmt = build(ctx, s)
+        if stmt is not None:
+            append(stmt)
+    return result
 
 
-def get_class_properties(cls, self_name):
+def get_class_properties(cls, self_name, get_method_def=None):
     """
     Get a list of Property objects representing the properties of a class.
 
     Arguments:
         cls:  The class to get properties of.
         self_name: The name of the class that the properties should belong to.
+        get_method_def: Callable taking (fn, def_name) that builds the Def of
+            a getter or setter. Defaults to `get_jit_def`.
     Returns:
         A list of Property objects corresponding to the properties of cls. Property
         here refers to the subclass of TreeView.
     """
-    props = inspect.getmembers(
-        cls, predicate=lambda m: isinstance(m, property))
+    if get_method_def is None:
+        def get_method_def(fn, def_name):
+            return get_jit_def(fn, def_name, self_name=self_name)
+
+    # Only look at what the class itself defines; going through getattr (as
+    # inspect.getmembers does) would walk the MRO and invoke descriptors
+    props = sorted((name, value) for name, value in cls.__dict__.items() if isinstance(value, property))
 
     # Create Property TreeView objects from inspected property objects.
     properties = []
     for prop in props:
-        getter = get_jit_def(prop[1].fget, f"__{prop[0]}_getter", self_name=self_name)
-        setter = get_jit_def(prop[1].fset, f"__{prop[0]}_setter", self_name=self_name) if prop[1].fset else None
+        getter = get_method_def(prop[1].fget, f"__{prop[0]}_getter")
+        setter = get_method_def(prop[1].fset, f"__{prop[0]}_setter") if prop[1].fset else None
         properties.append(Property(getter.range(), Ident(getter.range(), prop[0]), getter, setter))
 
     return properties
 
 
+def _dedent(source):
+    """
+    Strip the indentation of the first line from every line of `source`.
+
+    `inspect.getsource` output is already consistently indented, so unlike
+    `textwrap.dedent` this doesn't need a separate pass to find the common
+    margin. Lines that don't start with that much whitespace (e.g. the
+    contents of a multi-line string) are left untouched.
+
+    Returns: (dedented_source, leading_whitespace_len)
+    """
+    first_line = source.partition('\n')[0]
+    indent = len(first_line) - len(first_line.lstrip(' \t'))
+    if indent == 0:
+        return source, 0
+    lines = source.split('\n')
+    return '\n'.join(line[indent:] if line[:indent].isspace() or not line.strip() else line
+                     for line in lines), indent
+
+
+def _parse(source, filename, file_lineno=1, leading_whitespace_len=0):
+    # Same as ast.parse, but syntax errors point at the file the source came
+    # from. `source` is a dedented snippet of that file, starting on line
+    # `file_lineno`.
+    # Type comments are deliberately not requested (ast.PyCF_TYPE_COMMENTS) so
+    # the tokenizer doesn't have to track them; get_type_line reads them from
+    # the raw source instead. No optimization level is passed: it has no
+    # effect on an AST-only compile unless the tree is also constant-folded,
+    # which would change what gets scripted.
+    try:
+        return compile(source, filename or '<unknown>', 'exec', ast.PyCF_ONLY_AST, dont_inherit=True)
+    except SyntaxError as e:
+        if filename is not None and e.lineno is not None:
+            _shift_syntax_error(e, filename, file_lineno, leading_whitespace_len)
+        raise
+
+
+def _shift_syntax_error(e, filename, file_lineno, leading_whitespace_len):
+    # Move the location of `e` from the dedented snippet to the file. Only
+    # lines _dedent stripped were shifted left.
+    line = linecache.getline(filename, e.lineno + file_lineno - 1)
+    if not line:
+        return
+    dedented = line[:leading_whitespace_len].isspace()
+    if dedented and e.offset is not None:
+        e.offset += leading_whitespace_len
+    # Set from Python 3.10 on
+    if getattr(e, 'end_lineno', None) is not None:
+        if e.end_lineno != e.lineno:
+            # Whether the end line was dedented isn't known
+            e.end_offset = None
+        elif dedented and e.end_offset is not None:
+            e.end_offset += leading_whitespace_len
+        e.end_lineno += file_lineno - 1
+    e.lineno += file_lineno - 1
+    e.text = line
+
+
+# Memoized results of get_jit_def/get_jit_class_def. The TreeViews they return
+# are immutable, so scripting the same function or class again (e.g. when a
+# module type is re-scripted) can reuse them instead of re-reading and
+# re-parsing the source. Bounded so long-running processes that script many
+# distinct functions don't grow it without limit.
+_jit_def_cache = {}
+_JIT_DEF_CACHE_SIZE = 1024
+
+
+def _jit_def_key(fn, def_name, self_name):
+    # The source is read from the function `fn` wraps, if any, and
+    # functions wrapped by the same decorator share the wrapper's code
+    code = getattr(inspect.unwrap(fn), '__code__', None)
+    if code is None:
+        return None
+    # Closures share a code object but may carry different modifiers, so
+    # whether the body gets dropped is part of the key
+    return (code, def_name, self_name, should_drop(fn))
+
+
+def _cache_jit_def(key, result):
+    if key is None:
+        return result
+    if len(_jit_def_cache) >= _JIT_DEF_CACHE_SIZE:
+        # Evict the oldest entry; dicts preserve insertion order
+        del _jit_def_cache[next(iter(_jit_def_cache))]
+    _jit_def_cache[key] = result
+    return result
+
+
+# Memoized results of get_source_lines_and_file, keyed on the code object (or
+# the class) whose source they hold. A code object's source doesn't change
+# within a process, so repeated lookups can skip the filesystem and linecache.
+_source_lines_cache = {}
+_SOURCE_LINES_CACHE_SIZE = 1024
+
+
+def _get_source_lines_and_file(obj):
+    # inspect reads the source of the function `obj` wraps, if any, and
+    # functions wrapped by the same decorator share the wrapper's code
+    unwrapped = inspect.unwrap(obj)
+    key = (getattr(unwrapped, '__code__', unwrapped), getattr(unwrapped, '__module__', None))
+    cached = _source_lines_cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        result = get_source_lines_and_file(obj)
+    except OSError:
+        # The call stack is only needed for the error message, so it isn't
+        # collected unless the lookup fails
+        get_source_lines_and_file(obj, torch._C.ErrorReport.call_stack())
+        raise
+    if len(_source_lines_cache) >= _SOURCE_LINES_CACHE_SIZE:
+        del _source_lines_cache[next(iter(_source_lines_cache))]
+    _source_lines_cache[key] = result
+    return result
+
+
 def get_jit_class_def(cls, self_name):
-    # Get defs for each method within the current class independently
-    # TODO: proper overriding analysis when implementing class inheritance
-    methods = inspect.getmembers(
-        cls,
-        predicate=lambda m: (inspect.ismethod(m) or inspect.isfunction(m))
-        and not is_static_fn(cls, m.__name__)
-        and m.__name__ in cls.__dict__
-    )
-    methods = [get_jit_def(method[1],
-                           method[0],
-                           self_name=self_name) for method in methods]
-
-    properties = get_class_properties(cls, self_name)
-
-    sourcelines, file_lineno, filename = get_source_lines_and_file(cls, torch._C.ErrorReport.call_stack())
+    key = (cls, self_name)
+    cached = _jit_def_cache.get(key)
+    if cached is not None:
+        return cached
+
+    sourcelines, file_lineno, filename = _get_source_lines_and_file(cls)
     source = ''.join(sourcelines)
-    dedent_src = dedent(source)
-    py_ast = ast.parse(dedent_src)
-    leading_whitespace_len = len(source.split('\n', 1)[0]) - len(dedent_src.split('\n', 1)[0])
+    dedent_src, leading_whitespace_len = _dedent(source)
+    py_ast = _parse(dedent_src, filename, file_lineno, leading_whitespace_len)
+    py_def = py_ast.body[0]
     ctx = SourceContext(source, filename, file_lineno, leading_whitespace_len, False)
-    return build_class_def(ctx, py_ast.body[0], methods, properties, self_name)
+    method_ctx = SourceContext(source, filename, file_lineno, leading_whitespace_len, True)
+
+    # Index the functions defined directly in the class body by the line their
+    # source starts on (which is what `co_firstlineno` records), so methods can
+    # be built from the class AST instead of re-reading and re-parsing their
+    # source one by one.
+    method_asts = {}
+    for stmt in py_def.body:
+        if isinstance(stmt, ast.FunctionDef):
+            first_lineno = stmt.decorator_list[0].lineno if stmt.decorator_list else stmt.lineno
+            method_asts[file_lineno + first_lineno - 1] = stmt
+
+    def get_method_def(fn, def_name):
+        code = fn.__code__
+        fn_def = method_asts.get(code.co_firstlineno)
+        # `end_lineno` is needed to find the method's type comment and is only
+        # set from Python 3.8 on. Anything not found in the class body (e.g. a
+        # function defined elsewhere and assigned as an attribute) is handled
+        # by get_jit_def.
+        if fn_def is None or code.co_filename != filename or getattr(fn_def, 'end_lineno', None) is None:
+            return get_jit_def(fn, def_name, self_name=self_name)
+
+        fn_key = _jit_def_key(fn, def_name, self_name)
+        cached = _jit_def_cache.get(fn_key)
+        if cached is not None:
+            return cached
+        fn_source = ''.join(sourcelines[code.co_firstlineno - file_lineno:fn_def.end_lineno])
+        type_line = torch.jit.annotations.get_type_line(fn_source)
+        return _cache_jit_def(fn_key, get_jit_def_from_ast(fn, fn_def, method_ctx, type_line, def_name, self_name))
+
+    # Get defs for each method within the current class independently
+    # TODO: proper overriding analysis when implementing class inheritance
+    methods = []
+    for name, value in sorted(cls.__dict__.items()):
+        if isinstance(value, classmethod):
+            # Compiled through the bound method, as inspect.getmembers sees it
+            value = getattr(cls, name)
+        # Skip functions bound under a name that isn't their own (e.g. lambdas
+        # or functions defined outside the class), which aren't compiled
+        if (inspect.ismethod(value) or inspect.isfunction(value)) \
+                and not is_static_fn(cls, name) and value.__name__ in cls.__dict__:
+            methods.append(get_method_def(value, name))
+
+    properties = get_class_properties(cls, self_name, get_method_def)
+
+    return _cache_jit_def(key, build_class_def(ctx, py_def, methods, properties, self_name))
 
 
 def get_jit_def(fn, def_name, self_name=None):
@@ -191,20 +397,62 @@ def get_jit_def(fn, def_name, self_name=None):
             but we want the result AST to have the name "forward".
         self_name: If this function is a method, what the type name of `self` is.
     """
-    sourcelines, file_lineno, filename = get_source_lines_and_file(fn, torch._C.ErrorReport.call_stack())
+    key = _jit_def_key(fn, def_name, self_name)
+    cached = _jit_def_cache.get(key)
+    if cached is not None:
+        return cached
+
+    sourcelines, file_lineno, filename = _get_source_lines_and_file(fn)
     source = ''.join(sourcelines)
-    dedent_src = dedent(source)
-    py_ast = ast.parse(dedent_src)
+    dedent_src, leading_whitespace_len = _dedent(source)
+    py_ast = _parse(dedent_src, filename, file_lineno, leading_whitespace_len)
     if len(py_ast.body) != 1 or not isinstance(py_ast.body[0], ast.FunctionDef):
         raise RuntimeError("Expected a single top-level function")
-    leading_whitespace_len = len(source.split('\n', 1)[0]) - len(dedent_src.split('\n', 1)[0])
     type_line = torch.jit.annotations.get_type_line(source)
     ctx = SourceContext(source, filename, file_lineno, leading_whitespace_len, True)
-    fn_def = py_ast.body[0]
+    return _cache_jit_def(key, get_jit_def_from_ast(fn, py_ast.body[0], ctx, type_line, def_name, self_name))
+
 
+# Stand-in for the signature and body of @unused functions. Functions built on
+# their own start on line 1 of their SourceContext, so they share this copy; it
+# must not be modified.
+_unused_fn_source = "def unused_fn(self: Any):\n\traise RuntimeError(\"Cannot call @unused methods\")"
+_unused_fn_def = _parse(_unused_fn_source, None).body[0]
+
+
+@functools.lru_cache(128)
+def _get_shifted_unused_fn_def(first_lineno):
+    """
+    Returns the @unused stand-in moved to start on line `first_lineno`, for
+    methods built from their class's source. The result is shared between
+    callers and must not be modified.
+    """
+    unused_fn_def = _parse(_unused_fn_source, None).body[0]
+    ast.increment_lineno(unused_fn_def, first_lineno - 1)
+    return unused_fn_def
+
+
+def get_jit_def_from_ast(fn, fn_def, ctx, type_line, def_name, self_name=None):
+    """
+    Build a JIT AST (TreeView) from an already parsed `ast.FunctionDef` of `fn`.
+
+    Arguments:
+        fn: The function object `fn_def` was parsed from
+        fn_def: The `ast.FunctionDef` node of `fn`. It is modified in place
+            if `fn` is marked as unused.
+        ctx: The SourceContext that `fn_def`'s line and column numbers refer to
+        type_line: The type comment of `fn`, if any
+        def_name, self_name: See `get_jit_def`
+    """
     # Swap out the function signature and body if it is unused
     if should_drop(fn):
-        unused_fn_def = ast.parse("def unused_fn(self: Any):\n\traise RuntimeError(\"Cannot call @unused methods\")").body[0]
+        first_lineno = fn_def.decorator_list[0].lineno if fn_def.decorator_list else fn_def.lineno
+        # Point the replacement at the start of the function rather than at
+        # the start of whatever source the context covers
+        if first_lineno == 1:
+            unused_fn_def = _unused_fn_def
+        else:
+            unused_fn_def = _get_shifted_unused_fn_def(first_lineno)
         fn_def.body = unused_fn_def.body
         # kwarg/vararg not supported by `build_def`
         fn_def.args.kwarg = fn_def.args.vararg = None
@@ -216,24 +464,42 @@ def get_jit_def(fn, def_name, self_name=None):
 
 
 class Builder(object):
+    _DISPATCH = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super(Builder, cls).__init_subclass__(**kwargs)
+        # Map each AST node type to its build_<NodeName> handler up front, so
+        # dispatching a node is a single dict lookup instead of a getattr on
+        # a freshly concatenated method name.
+        dispatch = dict(cls._DISPATCH)
+        for name in vars(cls):
+            if not name.startswith('build_'):
+                continue
+            node_name = name[len('build_'):]
+            if node_name in _ast_constant_aliases:
+                continue
+            node_type = getattr(ast, node_name, None)
+            if isinstance(node_type, type):
+                dispatch[node_type] = getattr(cls, name)
+        cls._DISPATCH = dispatch
+
     def __call__(self, ctx, node):
-        method = getattr(self, 'build_' + node.__class__.__name__, None)
+        method = self._DISPATCH.get(type(node))
         if method is None:
             raise UnsupportedNodeError(ctx, node)
         return method(ctx, node)
 
 
 def build_class_def(ctx, py_def, methods, properties, self_name):
-    r = ctx.make_range(py_def.lineno, py_def.col_offset,
-                       py_def.col_offset + len("class"))
-    return ClassDef(Ident(r, self_name), [Stmt(method) for method in methods], properties)
+    r = _keyword_range(ctx, py_def, 5)  # len("class") == 5
+    return ClassDef(Ident(r, self_name), list(map(Stmt, methods)), properties)
 
 
 def build_def(ctx, py_def, type_line, def_name, self_name=None):
     body = py_def.body
     r = ctx.make_range(py_def.lineno + len(py_def.decorator_list),
                        py_def.col_offset,
-                       py_def.col_offset + len("def"))
+                       py_def.col_offset + 3)  # len("def") == 3
     param_list = build_param_list(ctx, py_def.args, self_name)
     return_type = None
     if getattr(py_def, 'returns', None) is not None:
@@ -291,6 +557,19 @@ def get_default_args(fn):
     if fn is None:
         return {}
 
+    # Plain functions carry their defaults directly, which is much cheaper
+    # than building a full Signature. Anything inspect.signature treats
+    # specially (wrappers, explicit signatures, bound methods and other
+    # callables) still goes through it.
+    if inspect.isfunction(fn) and not hasattr(fn, '__wrapped__') and not hasattr(fn, '__signature__'):
+        defaults = fn.__defaults__ or ()
+        code = fn.__code__
+        arg_names = code.co_varnames[code.co_argcount - len(defaults):code.co_argcount]
+        default_args = dict(zip(arg_names, defaults))
+        if fn.__kwdefaults__:
+            default_args.update(fn.__kwdefaults__)
+        return default_args
+
     signature = inspect.signature(fn)
     return {
         k: v.default
@@ -304,7 +583,7 @@ class WithItemBuilder(Builder):
     def build_withitem(ctx, item):
         lineno = item.context_expr.lineno
         start = item.context_expr.col_offset
-        end = start + len(pretty_node_names[ast.With])
+        end = start + 4  # len("with") == 4
         op_vars = item.optional_vars
         r = ctx.make_range(lineno, start, end)
 
@@ -323,7 +602,8 @@ class StmtBuilder(Builder):
     @staticmethod
     def build_Expr(ctx, stmt):
         value = stmt.value
-        if value.__class__.__name__ == 'Str':
+        value_type = type(value)
+        if (value_type is ast.Constant and isinstance(value.value, str)) or value_type is _ast_Str:
             # If a statement is a string literal expression,
             # then it is a docstring. Just ignore it.
             return None
@@ -333,7 +613,7 @@ class StmtBuilder(Builder):
     @staticmethod
     def build_Assign(ctx, stmt):
         rhs = build_expr(ctx, stmt.value)
-        lhs = list(map(lambda x: build_expr(ctx, x), stmt.targets))
+        lhs = [build_expr(ctx, x) for x in stmt.targets]
         return Assign(lhs, rhs)
 
     @staticmethod
@@ -348,26 +628,25 @@ class StmtBuilder(Builder):
     @staticmethod
     def build_Delete(ctx, stmt):
         if len(stmt.targets) > 1:
-            source_range = ctx.make_range(stmt.lineno, stmt.col_offset,
-                                          stmt.col_offset + len("del"))
+            source_range = _keyword_range(ctx, stmt, 3)  # len("del") == 3
             raise NotSupportedError(
                 source_range, 'del with more than one operand is not supported')
         return Delete(build_expr(ctx, stmt.targets[0]))
 
     @staticmethod
     def build_Return(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("return"))
+        r = _keyword_range(ctx, stmt, 6)  # len("return") == 6
         return Return(r, None if stmt.value is None else build_expr(ctx, stmt.value))
 
     @staticmethod
     def build_Raise(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("raise"))
+        r = _keyword_range(ctx, stmt, 5)  # len("raise") == 5
         expr = build_expr(ctx, stmt.exc)
         return Raise(r, expr)
 
     @staticmethod
     def build_Assert(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("assert"))
+        r = _keyword_range(ctx, stmt, 6)  # len("assert") == 6
         test = build_expr(ctx, stmt.test)
         msg = build_expr(ctx, stmt.msg) if stmt.msg is not None else None
         return Assert(r, test, msg)
@@ -377,9 +656,8 @@ class StmtBuilder(Builder):
         lhs = build_expr(ctx, stmt.target)
         rhs = build_expr(ctx, stmt.value)
         op = type(stmt.op)
-        if op in StmtBuilder.augassign_map:
-            op_token = StmtBuilder.augassign_map[op]
-        else:
+        op_token = _augassign_token(op)
+        if op_token is None:
             raise NotSupportedError(
                 find_before(ctx, rhs.range().start, '=', offsets=(-1, 0)),
                 "unsupported kind of augumented assignment: " + op.__name__)
@@ -391,50 +669,42 @@ class StmtBuilder(Builder):
             # TODO: try to recover the location of else:? Python doesn't give us useful
             # annotations in this case
             raise NotSupportedError(None, "else branches of while loops aren't supported")
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("while"))
+        r = _keyword_range(ctx, stmt, 5)  # len("while") == 5
         return While(r, build_expr(ctx, stmt.test),
                      build_stmts(ctx, stmt.body))
 
     @staticmethod
     def build_For(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("for"))
+        r = _keyword_range(ctx, stmt, 3)  # len("for") == 3
         return For(
             r, [build_expr(ctx, stmt.target)],
             [build_expr(ctx, stmt.iter)], build_stmts(ctx, stmt.body))
 
     @staticmethod
     def build_If(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("if"))
+        r = _keyword_range(ctx, stmt, 2)  # len("if") == 2
         return If(r, build_expr(ctx, stmt.test),
                   build_stmts(ctx, stmt.body),
                   build_stmts(ctx, stmt.orelse))
 
-    @staticmethod
-    def build_Print(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("print"))
-        if stmt.dest:
-            raise NotSupportedError(r, "print statements with non-default destinations aren't supported")
-        args = [build_expr(ctx, val) for val in stmt.values]
-        return ExprStmt(Apply(Var(Ident(r, "print")), args, []))
-
     @staticmethod
     def build_Pass(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("pass"))
+        r = _keyword_range(ctx, stmt, 4)  # len("pass") == 4
         return Pass(r)
 
     @staticmethod
     def build_Break(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("break"))
+        r = _keyword_range(ctx, stmt, 5)  # len("break") == 5
         return Break(r)
 
     @staticmethod
     def build_Continue(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("continue"))
+        r = _keyword_range(ctx, stmt, 8)  # len("continue") == 8
         return Continue(r)
 
     @staticmethod
     def build_With(ctx, stmt):
-        r = ctx.make_range(stmt.lineno, stmt.col_offset, stmt.col_offset + len("with"))
+        r = _keyword_range(ctx, stmt, 4)  # len("with") == 4
         return With(r, build_withitems(ctx, stmt.items), build_stmts(ctx, stmt.body))
 
 class ExprBuilder(Builder):
@@ -451,10 +721,9 @@ class ExprBuilder(Builder):
         ast.BitOr: '|',
         ast.LShift: '<<',
         ast.RShift: '>>',
+        ast.MatMult: '@',
     }
 
-    binop_map[ast.MatMult] = '@'
-
     unop_map = {
         ast.Not: 'not',
         ast.USub: '-',
@@ -484,13 +753,9 @@ class ExprBuilder(Builder):
         base = build_expr(ctx, expr.value)
         # expr.attr is just a string, so it's not annotated in any way, so we have
         # to build the range manually
-        source = ctx.source.encode('utf-8')
-
-        def get_char(index):
-            return chr(source[index])
-
+        source = _get_source_bytes(ctx)
         start_pos = base.range().end + 1
-        while get_char(start_pos) in string.whitespace:  # Skip whitespace
+        while source[start_pos] in _whitespace_bytes:  # Skip whitespace
             start_pos += 1
         end_pos = start_pos + len(expr.attr)
         name_range = ctx.make_raw_range(start_pos, end_pos)
@@ -498,14 +763,15 @@ class ExprBuilder(Builder):
 
     @staticmethod
     def build_Call(ctx, expr):
-        func = build_expr(ctx, expr.func)
-        args = [build_expr(ctx, py_arg) for py_arg in expr.args]
+        build = build_expr
+        func = build(ctx, expr.func)
+        args = [build(ctx, py_arg) for py_arg in expr.args]
         if hasattr(expr, 'starargs') and expr.starargs:
-            stararg_expr = build_expr(ctx, expr.starargs)
+            stararg_expr = build(ctx, expr.starargs)
             args += [Starred(stararg_expr.range(), stararg_expr)]
         kwargs = []
         for kw in expr.keywords:
-            kw_expr = build_expr(ctx, kw.value)
+            kw_expr = build(ctx, kw.value)
             # XXX: we could do a better job at figuring out the range for the name here
             if not kw.arg:
                 raise NotSupportedError(kw_expr.range(), 'keyword-arg expansion is not supported')
@@ -514,7 +780,7 @@ class ExprBuilder(Builder):
 
     @staticmethod
     def build_Ellipsis(ctx, expr):
-        r = ctx.make_range(expr.lineno, expr.col_offset, expr.col_offset + 3)  # len("...") == 3
+        r = _keyword_range(ctx, expr, 3)  # len("...") == 3
         return Dots(r)
 
     @staticmethod
@@ -523,12 +789,9 @@ class ExprBuilder(Builder):
         if expr.id.startswith(_reserved_prefix):
             raise NotSupportedError(r, "names of variables used in JIT-ed functions "
                                        "can't start with " + _reserved_prefix)
-        if expr.id == "True":
-            return TrueLiteral(r)
-        elif expr.id == "False":
-            return FalseLiteral(r)
-        elif expr.id == "None":
-            return NoneLiteral(r)
+        literal = _name_literals.get(expr.id)
+        if literal is not None:
+            return literal(r)
         return Var(Ident(r, expr.id))
 
     @staticmethod
@@ -554,7 +817,7 @@ class ExprBuilder(Builder):
             raise FrontendError(err_range, 'Division of ints in TorchScript uses Python 3 true '
                                 'division semantics. Please put `from __future__ '
                                 'import division` at the top of your file')
-        op_token = ExprBuilder.binop_map.get(op)
+        op_token = _binop_token(op)
         if op_token is None:
             err_range = ctx.make_raw_range(lhs.range().end, rhs.range().start)
             raise NotSupportedError(err_range, "unsupported binary operator: " + op.__name__)
@@ -564,7 +827,7 @@ class ExprBuilder(Builder):
     def build_UnaryOp(ctx, expr):
         sub_expr = build_expr(ctx, expr.operand)
         op = type(expr.op)
-        op_token = ExprBuilder.unop_map.get(op)
+        op_token = _unop_token(op)
         r = ctx.make_range(expr.lineno, expr.col_offset, expr.col_offset + len(op_token))
         if op_token is None:
             err_range = ctx.make_raw_range(r.start, sub_expr.range().end)
@@ -573,17 +836,22 @@ class ExprBuilder(Builder):
 
     @staticmethod
     def build_BoolOp(ctx, expr):
-        if len(expr.values) < 2:
-            raise AssertionError("expected at least 2 values in BoolOp, but got " + str(len(expr.values)))
-        sub_exprs = [build_expr(ctx, sub_expr) for sub_expr in expr.values]
+        values = expr.values
+        if len(values) < 2:
+            raise AssertionError("expected at least 2 values in BoolOp, but got " + str(len(values)))
+        build = build_expr
+        lhs = build(ctx, values[0])
+        rhs = build(ctx, values[1])
         op = type(expr.op)
-        op_token = ExprBuilder.boolop_map.get(op)
+        op_token = _boolop_token(op)
         if op_token is None:
-            err_range = ctx.make_raw_range(sub_exprs[0].range().end, sub_exprs[1].range().start)
+            err_range = ctx.make_raw_range(lhs.range().end, rhs.range().start)
             raise NotSupportedError(err_range, "unsupported boolean operator: " + op.__name__)
-        lhs = sub_exprs[0]
-        for rhs in sub_exprs[1:]:
-            lhs = BinOp(op_token, lhs, rhs)
+        # Fold left, so `a and b and c` becomes `(a and b) and c`
+        binop = BinOp
+        lhs = binop(op_token, lhs, rhs)
+        for i in range(2, len(values)):
+            lhs = binop(op_token, lhs, build(ctx, values[i]))
         return lhs
 
     @staticmethod
@@ -594,27 +862,27 @@ class ExprBuilder(Builder):
 
     @staticmethod
     def build_Compare(ctx, expr):
-        operands = [build_expr(ctx, e) for e in [expr.left] + list(expr.comparators)]
+        build = build_expr
+        make_raw_range = ctx.make_raw_range
+        lhs = build(ctx, expr.left)
         result = None
-        for lhs, op_, rhs in zip(operands, expr.ops, operands[1:]):
+        for op_, comparator in zip(expr.ops, expr.comparators):
+            rhs = build(ctx, comparator)
             op = type(op_)
-            op_token = ExprBuilder.cmpop_map.get(op)
-            r = ctx.make_raw_range(lhs.range().end, rhs.range().start)
+            op_token = _cmpop_token(op)
+            r = make_raw_range(lhs.range().end, rhs.range().start)
             if op_token is None:
                 raise NotSupportedError(r, "unsupported comparison operator: " + op.__name__)
 
-            if op == ast.NotIn:
+            if op is ast.NotIn:
                 # NB: `not in` is just `not( in )`, so we don't introduce new tree view
                 # but just make it a nested call in our tree view structure
-                in_expr = BinOp('in', lhs, rhs)
-                cmp_expr = UnaryOp(r, 'not', in_expr)
+                cmp_expr = UnaryOp(r, 'not', BinOp('in', lhs, rhs))
             else:
                 cmp_expr = BinOp(op_token, lhs, rhs)
 
-            if result is None:
-                result = cmp_expr
-            else:
-                result = BinOp('and', result, cmp_expr)
+            result = cmp_expr if result is None else BinOp('and', result, cmp_expr)
+            lhs = rhs
         return result
 
     @staticmethod
@@ -626,47 +894,54 @@ class ExprBuilder(Builder):
             return SliceExpr(base.range(), lower, upper, step)
 
         def build_Index(ctx, base, index_expr):
-            if isinstance(index_expr.value, ast.Tuple) or \
-                    isinstance(index_expr.value, ast.List):
+            if isinstance(index_expr, (ast.Tuple, ast.List)):
                 raise NotSupportedError(base.range(),
                                         "slicing multiple dimensions with "
                                         "sequences not supported yet")
-            return build_expr(ctx, index_expr.value)
+            return build_expr(ctx, index_expr)
 
-        def build_ExtSlice(ctx, base, extslice):
+        def build_ExtSlice(ctx, base, dims):
             sub_exprs = []
-            for expr in extslice.dims:
+            for expr in dims:
                 sub_type = type(expr)
-                if sub_type is ast.Index:
-                    sub_exprs.append(build_Index(ctx, base, expr))
+                if sub_type is _ast_Index:
+                    sub_exprs.append(build_Index(ctx, base, expr.value))
                 elif sub_type is ast.Slice:
                     sub_exprs.append(build_SliceExpr(ctx, base, expr))
-                elif sub_type is ast.Ellipsis:
+                elif sub_type is _ast_Ellipsis:
                     sub_exprs.append(Dots(base.range()))
+                elif _ast_Index is None:
+                    # From Python 3.9 on, plain indices aren't wrapped in ast.Index
+                    sub_exprs.append(build_Index(ctx, base, expr))
                 else:
                     raise NotSupportedError(base.range(),
                                             "slicing multiple dimensions with "
                                             "{} not supported".format(sub_type))
             return sub_exprs
 
-        base = build_expr(ctx, expr.value)
-        sub_type = type(expr.slice)
-        if sub_type is ast.Index:
-            if isinstance(expr.slice.value, ast.Tuple):
+        def build_indices(ctx, index_expr):
+            if isinstance(index_expr, ast.Tuple):
                 # N-dimensional indexing using Tuple: x[(i, j, k)] is equivalent to x[i, j, k]
                 # XXX: Indexing using a list is **different**! It triggers advanced indexing.
-                indices = []
-                for index_expr in expr.slice.value.elts:
-                    indices.append(build_expr(ctx, index_expr))
-                return Subscript(base, indices)
-            else:
-                return Subscript(base, [build_expr(ctx, expr.slice.value)])
-        elif sub_type is ast.Slice:
-            return Subscript(base, [build_SliceExpr(ctx, base, expr.slice)])
-        elif sub_type is ast.ExtSlice:
-            return Subscript(base, build_ExtSlice(ctx, base, expr.slice))
-        else:  # Ellipsis (can only happen in Python 2)
-            raise NotSupportedError(base.range(), "ellipsis is not supported")
+                build = build_expr
+                return [build(ctx, e) for e in index_expr.elts]
+            return [build_expr(ctx, index_expr)]
+
+        base = build_expr(ctx, expr.value)
+        slice_expr = expr.slice
+        sub_type = type(slice_expr)
+        if sub_type is ast.Slice:
+            return Subscript(base, [build_SliceExpr(ctx, base, slice_expr)])
+        elif sub_type is _ast_Index:
+            return Subscript(base, build_indices(ctx, slice_expr.value))
+        elif sub_type is _ast_ExtSlice:
+            return Subscript(base, build_ExtSlice(ctx, base, slice_expr.dims))
+        # From Python 3.9 on the index expression is used directly, and a tuple
+        # containing slices takes the place of ast.ExtSlice
+        elif sub_type is ast.Tuple and any(type(e) is ast.Slice for e in slice_expr.elts):
+            return Subscript(base, build_ExtSlice(ctx, base, slice_expr.elts))
+        else:
+            return Subscript(base, build_indices(ctx, slice_expr))
 
     @staticmethod
     def build_List(ctx, expr):
@@ -680,8 +955,9 @@ class ExprBuilder(Builder):
 
     @staticmethod
     def build_Dict(ctx, expr):
+        build = build_expr
         return DictLiteral(ctx.make_range(expr.lineno, expr.col_offset, expr.col_offset + 1),
-                           [build_expr(ctx, e) for e in expr.keys], [build_expr(ctx, e) for e in expr.values])
+                           [build(ctx, e) for e in expr.keys], [build(ctx, e) for e in expr.values])
 
     @staticmethod
     def build_Num(ctx, expr):
@@ -714,10 +990,11 @@ class ExprBuilder(Builder):
 
     @staticmethod
     def build_JoinedStr(ctx, expr):
+        make_range = ctx.make_range
         s = ''
         args = []
         for value in expr.values:
-            r = ctx.make_range(value.lineno, value.col_offset, value.col_offset + 1)
+            r = make_range(value.lineno, value.col_offset, value.col_offset + 1)
             if isinstance(value, ast.FormattedValue):
                 if value.conversion != -1:
                     raise NotSupportedError(r, 'Don\'t support conversion in JoinedStr')
@@ -730,7 +1007,7 @@ class ExprBuilder(Builder):
             else:
                 raise NotSupportedError(r, 'Unsupported value in JoinedStr')
 
-        r = ctx.make_range(expr.lineno, expr.col_offset, expr.col_offset + 1)
+        r = make_range(expr.lineno, expr.col_offset, expr.col_offset + 1)
         return Apply(Select(StringLiteral(r, s), Ident(r, 'format')), args, [])
 
     @staticmethod
@@ -757,6 +1034,14 @@ build_expr = ExprBuilder()
 build_stmt = StmtBuilder()
 build_withitem = WithItemBuilder()
 
+# Bound lookups into the operator tables above, so the builders don't have to
+# go through the class attribute on every operator node
+_augassign_token = StmtBuilder.augassign_map.get
+_binop_token = ExprBuilder.binop_map.get
+_unop_token = ExprBuilder.unop_map.get
+_boolop_token = ExprBuilder.boolop_map.get
+_cmpop_token = ExprBuilder.cmpop_map.get
+
 def find_before(ctx, pos, substr, offsets=(0, 0)):
-    new_pos = ctx.source[:pos].rindex(substr)
+    new_pos = _get_source_bytes(ctx).rindex(substr.encode('utf-8'), 0, pos)
     return ctx.make_raw_range(new_pos + offsets[0], new_pos + len(substr) + offsets[1])